@@ -1,9 +1,52 @@
 #!/usr/bin/env python3
 
 
+import concurrent.futures
 import csv
 import datetime
-import glob
+import io
+import os
+from collections import defaultdict
+from functools import lru_cache
+from operator import itemgetter
+
+
+# Samsung Health stores the timestamps as milliseconds from Unix epoch.
+EPOCH = datetime.date(1970, 1, 1)
+MILLISECONDS_PER_DAY = 24 * 60 * 60 * 1000
+
+
+@lru_cache(maxsize=None)
+def list_files():
+    """
+    List the names of all files in the current directory. The directory is only scanned once,
+    no matter how many different data files we are looking for.
+    """
+    with os.scandir() as entries:
+        return tuple(entry.name for entry in entries if entry.is_file())
+
+
+def find_file(prefix):
+    """
+    Return the name of the first CSV file whose name starts with the given prefix,
+    e.g. com.samsung.health.weight. for com.samsung.health.weight.*.csv, or None.
+    """
+    for name in list_files():
+        if name.startswith(prefix) and name.endswith(".csv"):
+            return name
+    return None
+
+
+@lru_cache(maxsize=None)
+def date_from_timestamp(timestamp):
+    """
+    Convert Samsung's timestamp (milliseconds from Unix epoch, as read from the CSV file)
+    to a YYYY-MM-DD date. The same day is often recorded several times, so the result is cached.
+    The day_time columns contain midnight UTC of the given day, so we only need to count
+    the days since the epoch. Going through the local time zone would shift the date by one
+    day for users west of UTC.
+    """
+    return (EPOCH + datetime.timedelta(days=int(timestamp) // MILLISECONDS_PER_DAY)).isoformat()
 
 
 def fetch_floor_data():
@@ -12,27 +55,24 @@ def fetch_floor_data():
     because floors climbed seem to be stored whenever they are registered. So we have to group
     them all and add them up.
     """
-    floor_files = glob.glob("com.samsung.health.floors_climbed.*.csv")
-    if len(floor_files) == 0:
+    filename = find_file("com.samsung.health.floors_climbed.")
+    if filename is None:
         raise Exception("No floors data found.")
-    filename = floor_files[0]
 
     with open(filename, newline="") as floor_data:
         # Skip first line
         next(floor_data)
-        reader = csv.DictReader(floor_data)
-        floor_data = {}
-        for row in reader:
-            date = row["start_time"][0:10]
-            floors = int(float(row["floor"]))
-            # If there are floors for this date, add the newly read data to the existing value.
-            # Otherwise, create a new key.
-            if date in floor_data:
-                floor_data[date] += floors
-            else:
-                floor_data[date] = floors
+        reader = csv.reader(floor_data)
+        # Look up the column indices once, instead of building a dict for every row.
+        header = next(reader)
+        columns = itemgetter(header.index("start_time"), header.index("floor"))
+        floor_data = defaultdict(int)
+        # Let itemgetter pick the two columns we need, so the loop body only has to
+        # group the floors by date and add them up.
+        for start_time, floors in map(columns, reader):
+            floor_data[start_time[0:10]] += int(float(floors))
 
-    return floor_data
+    return dict(floor_data)
 
 
 def fetch_calorie_data():
@@ -40,24 +80,25 @@ def fetch_calorie_data():
     Fetch the calorie data.
     """
 
-    calorie_files = glob.glob("com.samsung.shealth.calories_burned.details.*.csv")
-    if len(calorie_files) == 0:
+    filename = find_file("com.samsung.shealth.calories_burned.details.")
+    if filename is None:
         raise Exception("No calorie data found.")
-    filename = calorie_files[0]
 
     with open(filename, newline="") as calories_data:
         # Skip first line
         next(calories_data)
-        reader = csv.DictReader(calories_data)
-        calorie_data = {}
+        reader = csv.reader(calories_data)
+        header = next(reader)
         prefix = "com.samsung.shealth.calories_burned."
-        for row in reader:
-            date = datetime.datetime.fromtimestamp(
-                int(row[prefix + "day_time"]) / 1000
-            ).strftime("%Y-%m-%d")
-            rest_calorie = float(row[prefix + "rest_calorie"])
-            active_calorie = float(row[prefix + "active_calorie"])
-            calorie_data[date] = int(round(rest_calorie + active_calorie, 0))
+        columns = itemgetter(
+            header.index(prefix + "day_time"),
+            header.index(prefix + "rest_calorie"),
+            header.index(prefix + "active_calorie"),
+        )
+        calorie_data = {}
+        for day_time, rest_calorie, active_calorie in map(columns, reader):
+            date = date_from_timestamp(day_time)
+            calorie_data[date] = int(round(float(rest_calorie) + float(active_calorie), 0))
 
         return calorie_data
 
@@ -67,27 +108,31 @@ def fetch_activity_data():
     Fetch the activity data.
     """
 
-    activity_files = glob.glob("com.samsung.shealth.activity.day_summary.*.csv")
-    if len(activity_files) == 0:
+    filename = find_file("com.samsung.shealth.activity.day_summary.")
+    if filename is None:
         raise Exception("No activity data found.")
-    filename = activity_files[0]
 
     with open(filename, newline="") as activity_data:
         # Skip first line
         next(activity_data)
-        reader = csv.DictReader(activity_data)
+        reader = csv.reader(activity_data)
+        header = next(reader)
+        i_date = header.index("day_time")
+        i_steps = header.index("step_count")
+        i_distance = header.index("distance")
+        i_calorie = header.index("calorie")
+        i_run = header.index("run_time")
+        i_walk = header.index("walk_time")
         activity_data = {}
         for row in reader:
-            date = datetime.datetime.fromtimestamp(
-                int(row["day_time"]) / 1000
-            ).strftime("%Y-%m-%d")
-            step_count = int(row["step_count"])
+            date = date_from_timestamp(row[i_date])
+            step_count = int(row[i_steps])
             # Samsung Health stores the distance in m, Garmin Connect expects it to be in km.
-            distance = round(float(row["distance"]) / 1000, 2)
-            calorie = float(row["calorie"])
+            distance = round(float(row[i_distance]) / 1000, 2)
+            calorie = float(row[i_calorie])
             # Times are stored in milliseconds.
-            run_time = int(row["run_time"]) / 60000
-            walk_time = int(row["walk_time"]) / 60000
+            run_time = int(row[i_run]) / 60000
+            walk_time = int(row[i_walk]) / 60000
             activity_data[date] = {
                 "Steps": step_count,
                 "Distance": distance,
@@ -102,30 +147,37 @@ def fetch_activity_data():
 
 
 def merge_data(floors, calories, activities):
+    """
+    Merge the floors, calories and activity data into one row per date, sorted by date.
+    """
     merged_data = {}
 
-    for date, cals in calories.items():
-        merged_data[date] = {"Calories Burned": cals}
-
-    for date, f in floors.items():
-        if date not in merged_data:
-            merged_data[date]["Calories"] = 0
-        merged_data[date]["Floors"] = f
-
-    for date, dic in activities.items():
+    # Every date is only visited once, so we can build its complete row right away.
+    for date in sorted(calories.keys() | floors.keys() | activities.keys()):
+        activity = activities.get(date, {})
         # If no steps have been recorded for a given date, we can drop that entry entirely,
         # because that means other data will not be useful anyway: no activity calories, no distance
         # no intensity minutes.
-        dropkey = dic["Steps"] == 0
-        if date in merged_data:
-            if dropkey:
-                merged_data.pop(date)
-            else:
-                merged_data[date].update(dic)
-        else:
-            merged_data[date] = dic
+        if activity.get("Steps") == 0:
+            continue
+
+        row = {"Date": date}
+        if date in calories:
+            row["Calories Burned"] = calories[date]
+        if date in floors:
+            row["Floors"] = floors[date]
+        row.update(activity)
+        merged_data[date] = row
+
+    return merged_data
 
-    return dict(sorted(merged_data.items()))
+
+def save_file(filename, content):
+    """
+    Write the prepared content of one CSV file.
+    """
+    with open(filename, "w", newline="") as dest:
+        dest.write(content)
 
 
 def write_to_file(data):
@@ -138,8 +190,6 @@ def write_to_file(data):
     """
     LINES_PER_FILE = 100
 
-    dest = None
-    lines_written = 0
     columns = [
         "Date",
         "Calories Burned",
@@ -152,28 +202,25 @@ def write_to_file(data):
         "Minutes Very Active",
         "Activity Calories",
     ]
-    for d in data:
-        # Add the date key to the row.
-        data[d]["Date"] = d
-        if lines_written % LINES_PER_FILE == 0:
-            filename = f"activities-export-{lines_written // LINES_PER_FILE + 1}.csv"
-            if hasattr(dest, "close"):
-                dest.close()
-
-            dest = open(filename, "w", newline="")
-            dest.write("Activities\n")
-            writer = csv.DictWriter(
-                dest, fieldnames=columns, lineterminator="\n", quoting=csv.QUOTE_ALL
-            )
-            writer.writeheader()
-
-        writer.writerow(data[d])
-        lines_written += 1
-
-    try:
-        dest.close()
-    except:
-        pass
+    rows = list(data.values())
+    files = {}
+    for lines_written in range(0, len(rows), LINES_PER_FILE):
+        filename = f"activities-export-{lines_written // LINES_PER_FILE + 1}.csv"
+
+        # Assemble the whole file in memory first, so it can be written with a single call.
+        buffer = io.StringIO()
+        buffer.write("Activities\n")
+        writer = csv.DictWriter(
+            buffer, fieldnames=columns, lineterminator="\n", quoting=csv.QUOTE_ALL
+        )
+        writer.writeheader()
+        writer.writerows(rows[lines_written : lines_written + LINES_PER_FILE])
+
+        files[filename] = buffer.getvalue()
+
+    # Writing the files is I/O bound, so we can write them all at the same time.
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        list(executor.map(save_file, files.keys(), files.values()))
 
 
 data = merge_data(fetch_floor_data(), fetch_calorie_data(), fetch_activity_data())
@@ -1,12 +1,22 @@
 #!/usr/bin/env python3
 
+import bisect
+import concurrent.futures
 import csv
 import datetime
-import glob
 import json
 import os
+from functools import lru_cache
+from operator import itemgetter
+from xml.sax.saxutils import escape, quoteattr
 from lxml import etree as XML
 
+# orjson is a lot faster than the json module from the standard library, but it is optional.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 # Define the various namespaces
 nsmap = {
@@ -18,9 +28,33 @@ nsmap = {
     "xsi": "http://www.w3.org/2001/XMLSchema-instance",
 }
 
-# Return the right qualified name for a given name space.
-def ns3_tag(name):
-    return XML.QName(nsmap["ns3"], name)
+# The types of data a live data entry can contain.
+LIVE_DATA_KEYS = ("distance", "cadence", "heart_rate", "speed")
+
+# Samsung Health stores the timestamps as milliseconds from Unix epoch.
+EPOCH = datetime.date(1970, 1, 1)
+MILLISECONDS_PER_DAY = 24 * 60 * 60 * 1000
+
+
+@lru_cache(maxsize=None)
+def list_files():
+    """
+    List the names of all files in the current directory. The directory is only scanned once,
+    no matter how many different data files we are looking for.
+    """
+    with os.scandir() as entries:
+        return tuple(entry.name for entry in entries if entry.is_file())
+
+
+def find_file(prefix):
+    """
+    Return the name of the first CSV file whose name starts with the given prefix,
+    e.g. com.samsung.health.weight. for com.samsung.health.weight.*.csv, or None.
+    """
+    for name in list_files():
+        if name.startswith(prefix) and name.endswith(".csv"):
+            return name
+    return None
 
 
 def fetch_exercise_list():
@@ -30,10 +64,9 @@ def fetch_exercise_list():
     The list also tells us, whether there is live data (e.g. heart rate) and/or location data
     available.
     """
-    exercise_files = glob.glob("com.samsung.shealth.exercise.*.csv")
-    if len(exercise_files) == 0:
+    filename = find_file("com.samsung.shealth.exercise.")
+    if filename is None:
         raise Exception("No exercise data found.")
-    filename = exercise_files[0]
 
     prefix = "com.samsung.health.exercise."
     fields = [
@@ -57,17 +90,29 @@ def fetch_exercise_list():
     with open(filename, newline="") as exercise_list:
         # Skip first line
         next(exercise_list)
-        reader = csv.DictReader(exercise_list)
-        data = []
-        for row in reader:
-            dataset = {}
-            for f in fields:
-                dataset[f.replace(prefix, "")] = row[f]
-            data.append(dataset)
+        reader = csv.reader(exercise_list)
+        # The datasets use the field names without the prefix. Both the short names and the
+        # column indices only depend on the header, so we determine them once.
+        header = next(reader)
+        names = [f.replace(prefix, "") for f in fields]
+        columns = itemgetter(*[header.index(f) for f in fields])
+        data = [dict(zip(names, columns(row))) for row in reader]
 
         return data
 
 
+def load_json(filename):
+    """
+    Read and parse a JSON file, using orjson if it is installed.
+    """
+    if orjson is None:
+        with open(filename) as f:
+            return json.load(f)
+
+    with open(filename, "rb") as f:
+        return orjson.loads(f.read())
+
+
 def fetch_live_data(uuid):
     """
     Fetch the live data (e.g. heart rate) from the file mentioned in the exercise list.
@@ -75,8 +120,7 @@ def fetch_live_data(uuid):
     """
     subdir = uuid[0]
     filename = f"jsons/com.samsung.shealth.exercise/{subdir}/{uuid}.com.samsung.health.exercise.live_data.json"
-    with open(filename) as f:
-        live_data = json.load(f)
+    live_data = load_json(filename)
 
     return live_data
 
@@ -88,8 +132,7 @@ def fetch_location_data(uuid):
     """
     subdir = uuid[0]
     filename = f"jsons/com.samsung.shealth.exercise/{subdir}/{uuid}.com.samsung.health.exercise.location_data.json"
-    with open(filename) as f:
-        location_data = json.load(f)
+    location_data = load_json(filename)
 
     return location_data
 
@@ -120,36 +163,46 @@ def create_lap(
     The order and requirements are described in the schemas:
     https://www8.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd
     https://www8.garmin.com/xmlschemas/ActivityExtensionv2.xsd
+
+    Note: Just like the trackpoints, the lap is assembled directly as UTF-8 encoded XML code.
+    The closing </Lap> tag is not included, because the <Track> still has to be added.
     """
-    lap = XML.Element("Lap", {"StartTime": start_time})
+    parts = [b"<Lap StartTime=%s>" % quoteattr(start_time).encode()]
     if duration:
         duration = int(duration) / 1000
-        XML.SubElement(lap, "TotalTimeSeconds").text = str(duration)
+        parts.append(b"<TotalTimeSeconds>%s</TotalTimeSeconds>" % str(duration).encode())
     if distance:
-        XML.SubElement(lap, "DistanceMeters").text = distance
+        parts.append(b"<DistanceMeters>%s</DistanceMeters>" % escape(distance).encode())
     if max_speed:
-        XML.SubElement(lap, "MaximumSpeed").text = max_speed
+        parts.append(b"<MaximumSpeed>%s</MaximumSpeed>" % escape(max_speed).encode())
     if calories:
-        XML.SubElement(lap, "Calories").text = str(int(round(float(calories), 0)))
+        parts.append(b"<Calories>%d</Calories>" % int(round(float(calories), 0)))
     if avg_hr and avg_hr != "0.0":
-        ahr = XML.SubElement(lap, "AverageHeartRateBpm")
-        XML.SubElement(ahr, "Value").text = str(int(float(avg_hr)))
+        parts.append(
+            b"<AverageHeartRateBpm><Value>%d</Value></AverageHeartRateBpm>"
+            % int(float(avg_hr))
+        )
     if max_hr and avg_hr != "0.0":
-        mhr = XML.SubElement(lap, "MaximumHeartRateBpm")
-        XML.SubElement(mhr, "Value").text = str(int(float(max_hr)))
-    XML.SubElement(lap, "Intensity").text = "Active"
-    XML.SubElement(lap, "TriggerMethod").text = "Manual"
+        parts.append(
+            b"<MaximumHeartRateBpm><Value>%d</Value></MaximumHeartRateBpm>"
+            % int(float(max_hr))
+        )
+    parts.append(b"<Intensity>Active</Intensity><TriggerMethod>Manual</TriggerMethod>")
     if avg_speed or avg_cadence or max_cadence:
-        ext = XML.SubElement(lap, "Extensions")
-        lx = XML.SubElement(ext, ns3_tag("LX"))
-        if avg_speed and avg_speed != "0.0":
-            XML.SubElement(lx, ns3_tag("AvgSpeed")).text = avg_speed
-        if avg_cadence and avg_cadence != "0.0":
-            XML.SubElement(lx, ns3_tag("AvgRunCadence")).text = avg_cadence
-        if max_cadence and max_cadence != "0.0":
-            XML.SubElement(lx, ns3_tag("MaxRunCadence")).text = max_cadence
-
-    return lap
+        extensions = (
+            (b"AvgSpeed", avg_speed),
+            (b"AvgRunCadence", avg_cadence),
+            (b"MaxRunCadence", max_cadence),
+        )
+        parts.append(b"<Extensions><ns3:LX>")
+        parts.extend(
+            b"<ns3:%s>%s</ns3:%s>" % (tag, escape(value).encode(), tag)
+            for tag, value in extensions
+            if value and value != "0.0"
+        )
+        parts.append(b"</ns3:LX></Extensions>")
+
+    return b"".join(parts)
 
 
 def create_trackpoint(data):
@@ -171,34 +224,44 @@ def create_trackpoint(data):
     with the values that Garmin Connect calculates based on the GPS coordinates. This
     can lead to strange effects when viewing the activity details. The same is valid for the
     trackpoint extension Speed.
+
+    Note: The trackpoints make up the bulk of the file and their structure is simple and fixed.
+    So instead of creating lots of small XML elements, we directly assemble the UTF-8 encoded
+    tag. All values are numbers or timestamps, so there is nothing to escape.
     """
-    trackpoint = XML.Element("Trackpoint")
-    XML.SubElement(trackpoint, "Time").text = data["time"]
+    parts = [b"<Trackpoint><Time>%s</Time>" % data["time"].encode()]
     if data.get("altitude") and data.get("longitude"):
-        position = XML.SubElement(trackpoint, "Position")
-        XML.SubElement(position, "LatitudeDegrees").text = str(data["latitude"])
-        XML.SubElement(position, "LongitudeDegrees").text = str(data["longitude"])
+        parts.append(
+            b"<Position><LatitudeDegrees>%s</LatitudeDegrees>"
+            b"<LongitudeDegrees>%s</LongitudeDegrees></Position>"
+            % (str(data["latitude"]).encode(), str(data["longitude"]).encode())
+        )
     # Not used, see above.
     # if data.get("altitude"):
-    #    XML.SubElement(trackpoint, "AltitudeMeters").text = str(data["altitude"])
+    #    parts.append(b"<AltitudeMeters>%s</AltitudeMeters>" % str(data["altitude"]).encode())
     # Not used, see above.
     # if data.get("distance"):
-    #    XML.SubElement(trackpoint, "DistanceMeters").text = str(data["distance"])
+    #    parts.append(b"<DistanceMeters>%s</DistanceMeters>" % str(data["distance"]).encode())
     if data.get("heart_rate"):
-        hr = XML.SubElement(trackpoint, "HeartRateBpm")
-        XML.SubElement(hr, "Value").text = str(data["heart_rate"])
+        parts.append(
+            b"<HeartRateBpm><Value>%s</Value></HeartRateBpm>"
+            % str(data["heart_rate"]).encode()
+        )
     if data.get("cadence"):
-        XML.SubElement(trackpoint, "Cadence").text = str(data["cadence"])
+        parts.append(b"<Cadence>%s</Cadence>" % str(data["cadence"]).encode())
     # Not used, see above.
     # if data.get("speed"):
-    #    tpx = XML.SubElement(trackpoint, ns3_tag("TPX"))
-    #    XML.SubElement(tpx, ns3_tag("Speed")).text = str(data["speed"])
+    #    parts.append(
+    #        b"<Extensions><ns3:TPX><ns3:Speed>%s</ns3:Speed></ns3:TPX></Extensions>"
+    #        % str(data["speed"]).encode()
+    #    )
 
     # If the trackpoint only contains one tag, it is the <Time> information, so the trackpoint
     # is basically empty. It should not be added to the file.
-    if len(trackpoint) == 1:
+    if len(parts) == 1:
         return None
-    return trackpoint
+    parts.append(b"</Trackpoint>")
+    return b"".join(parts)
 
 
 def create_activity(id, sport="Other"):
@@ -221,44 +284,6 @@ def create_activity(id, sport="Other"):
     return act
 
 
-def create_root():
-    """
-    This prepares the XML file's root tag.
-    """
-    attr_qname = XML.QName(nsmap["xsi"], "schemaLocation")
-    root = XML.Element(
-        "TrainingCenterDatabase",
-        {
-            attr_qname: "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2 http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd"
-        },
-        version="1.1",
-        nsmap=nsmap,
-    )
-    XML.SubElement(root, "Activities")
-    return root
-
-
-def build_xml(a_id, ex_type, lap, trackpoints=[]):
-    """
-    Build a valid TCX file with all the data we have prepared.
-    """
-    root = create_root()
-    activity = create_activity(a_id, ex_type)
-    track = XML.Element("Track")
-    root.find("*").append(activity)
-    activity.append(lap)
-    for tp in trackpoints:
-        # Empty trackpoints should not be added.
-        if tp is not None:
-            track.append(tp)
-
-    # We only add the track, if it contains at least one trackpoint.
-    if len(track) > 0:
-        lap.append(track)
-
-    return XML.tostring(root, pretty_print=True, encoding="utf-8", xml_declaration=True)
-
-
 def convert_activity_type(stype):
     """
     This converts Samsung Health's exercise type to a valid sport type for the <Activity>.
@@ -276,21 +301,45 @@ def convert_activity_type(stype):
     return "Other"
 
 
-def find_nearest_time(ts, data):
+def find_nearest_time(ts, timestamps):
     """
-    This function searches data and finds the timestamp that is closes to ts.
-    We need this to avoid having e.g. trackpoints with a heart rate, but no
+    This function searches the sorted list timestamps and finds the timestamp that is closest
+    to ts. We need this to avoid having e.g. trackpoints with a heart rate, but no
     GPS information. Garmin Connect will not properly handle that and we get strange
     results. So it is better to lose some accuracy by shifting the live data a bit.
     """
-    timestamps = list(sorted(map(lambda d: d["start_time"], data)))
+    # As the list is sorted, the closest match is one of the neighbours of the position
+    # where ts would be inserted. If both are equally close, we take the earlier one.
+    i = bisect.bisect_left(timestamps, ts)
+    if i == 0:
+        return timestamps[0]
+    if i == len(timestamps):
+        return timestamps[-1]
+    before, after = timestamps[i - 1], timestamps[i]
+    if after - ts < ts - before:
+        return after
+    return before
+
+
+@lru_cache(maxsize=None)
+def date_prefix(day):
+    """
+    Return the date part of a TCX timestamp, e.g. 2020-01-16T, for the given number
+    of days since the Unix epoch.
+    """
+    return (EPOCH + datetime.timedelta(days=day)).strftime("%Y-%m-%dT")
 
-    closest_match = 0
-    for t in timestamps:
-        if abs(t - ts) < abs(closest_match - ts):
-            closest_match = t
 
-    return closest_match
+def format_time(ts):
+    """
+    Convert the timestamp (milliseconds from Unix epoch, UTC) to the proper format,
+    e.g. 2020-01-16T18:00:02.000Z. All trackpoints of an exercise are normally on the
+    same day, so only the time of day has to be calculated for each of them.
+    """
+    day, milliseconds = divmod(ts, MILLISECONDS_PER_DAY)
+    minutes, seconds = divmod(milliseconds // 1000, 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%s%02d:%02d:%02d.000Z" % (date_prefix(day), hours, minutes, seconds)
 
 
 def merge_location_and_live_data(locationdata, livedata):
@@ -300,74 +349,73 @@ def merge_location_and_live_data(locationdata, livedata):
     until we get a new heart rate. Without this, the heart rate will not be shown correctly in
     Garmin Connect. Instead of having a nice diagram, the user will just see a few spikes and
     heart rate will be counted as zero for the trackpoints where HR data is missing.
+    Return the merged trackpoints as a list, sorted by time.
     """
     merged_data = {}
 
     for entry in locationdata:
-        # Convert the timestamp (milliseconds from Unix epoch) to the proper format.
-        time = datetime.datetime.fromtimestamp(
-            entry["start_time"] / 1000, datetime.timezone.utc
-        ).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        ts = entry["start_time"]
 
         # First, we copy the location data.
-        if entry["start_time"] not in merged_data:
-            merged_data[entry["start_time"]] = {
-                "time": time,
+        if ts not in merged_data:
+            trackpoint = merged_data[ts] = {
+                "time": format_time(ts),
                 "latitude": entry["latitude"],
                 "longitude": entry["longitude"],
             }
             if "altitude" in entry:
-                merged_data[entry["start_time"]]["altitude"] = entry["altitude"]
+                trackpoint["altitude"] = entry["altitude"]
 
-    # Now for the live data...
+    # Now for the live data... The location timestamps are sorted once, so we can
+    # quickly find the nearest one for every live data entry.
+    timestamps = sorted(merged_data)
     for entry in livedata:
         ts = entry["start_time"]
         # If necessary, shift the timestamp a bit, in order to have the live data included
         # in an existing trackpoint that has position data in it.
-        if ts not in merged_data and locationdata:
-            ts = find_nearest_time(ts, locationdata)
-            entry["start_time"] = ts
+        if ts not in merged_data and timestamps:
+            ts = find_nearest_time(ts, timestamps)
 
-        # Convert the (maybe updated) timestamp to the proper format.
-        time = datetime.datetime.fromtimestamp(
-            ts / 1000, datetime.timezone.utc
-        ).strftime("%Y-%m-%dT%H:%M:%S.000Z")
-
-        # If there is heart rate data, it must be an integer.
-        if "heart_rate" in entry:
-            entry["heart_rate"] = int(entry["heart_rate"])
+        trackpoint = merged_data.get(ts)
 
         # Live data entries can contain various types of data, we do not know
         # beforehand what we can expect, so we try them all.
-        for key in ["distance", "cadence", "heart_rate", "speed"]:
-            if entry.get(key):
-                # If the timestamp is not yet in the merged_data, we create a new entry.
-                # This can happen, if there was no location data, because in that case
-                # we kept the original timestamp and did not try to shift it.
-                if ts not in merged_data:
-                    merged_data[ts] = {"time": time, key: entry[key]}
-
-                # If the key is not already there, add it to the merged data. But do not
-                # overwrite existing stuff.
-                if key not in merged_data[ts]:
-                    merged_data[ts][key] = entry[key]
+        for key in LIVE_DATA_KEYS:
+            value = entry.get(key)
+            # If there is heart rate data, it must be an integer.
+            if key == "heart_rate" and value is not None:
+                value = int(value)
+            if not value:
+                continue
+
+            # If the timestamp is not yet in the merged_data, we create a new entry.
+            # This can happen, if there was no location data, because in that case
+            # we kept the original timestamp and did not try to shift it.
+            if trackpoint is None:
+                trackpoint = merged_data[ts] = {"time": format_time(ts)}
+
+            # If the key is not already there, add it to the merged data. But do not
+            # overwrite existing stuff.
+            if key not in trackpoint:
+                trackpoint[key] = value
 
     # Last step: copy heart rate into upcoming trackpoints, if they don't have one.
     # Otherwise, Garmin Connect will assume the heart rate was zero at those positions.
-    merged_data = dict(sorted(merged_data.items()))
+    # The trackpoints must be in chronological order, so we sort them by their timestamp.
+    trackpoints = [merged_data[ts] for ts in sorted(merged_data)]
     hr = 0
-    for d in merged_data:
-        if merged_data[d].get("heart_rate"):
-            hr = merged_data[d].get("heart_rate")
+    for trackpoint in trackpoints:
+        if trackpoint.get("heart_rate"):
+            hr = trackpoint["heart_rate"]
         else:
-            merged_data[d]["heart_rate"] = hr
+            trackpoint["heart_rate"] = hr
 
-    return merged_data
+    return trackpoints
 
 
-def prepare_exercise_data(exercise):
+def prepare_exercise_data(exercise, filename):
     """
-    Fetch and merge the data for the given exercise and create proper XML.
+    Fetch and merge the data for the given exercise and write it as proper XML to the given file.
     """
 
     # The time code is used as the Id and StartTime for the lap. It is almost in the right format,
@@ -390,42 +438,79 @@ def prepare_exercise_data(exercise):
     )
 
     live_data = []
-    if ex["live_data"]:
-        live_data = fetch_live_data(ex["datauuid"])
+    if exercise["live_data"]:
+        live_data = fetch_live_data(exercise["datauuid"])
 
     location_data = []
-    if ex["location_data"]:
-        location_data = fetch_location_data(ex["datauuid"])
+    if exercise["location_data"]:
+        location_data = fetch_location_data(exercise["datauuid"])
 
     data = merge_location_and_live_data(location_data, live_data)
-    trackpoints = []
-    for d in data:
-        trackpoints.append(create_trackpoint(data[d]))
+    trackpoints = (create_trackpoint(d) for d in data)
 
-    return build_xml(time, ex_type, lap, trackpoints)
+    write_to_file(filename, create_activity(time, ex_type), lap, trackpoints)
 
 
-def write_to_file(filename, xml):
+def write_to_file(filename, activity, lap, trackpoints=[]):
     """
-    Simply write the XML code into a file.
+    Write a valid TCX file with all the data we have prepared. The file is written
+    incrementally, so the document never has to be kept in memory as a whole. The
+    lap and the trackpoints are already serialized, so they are written to the file as they are.
     """
-    with open(filename, "w", newline="") as f:
-        f.write(xml.decode())
-
-
-# We will generate quite a bunch of files, so it is better to have them all in one
-# subdir.
-if not os.path.isdir("exports"):
-    os.makedirs("exports")
-
-print("Fetching exercises...", end="")
-exercises = fetch_exercise_list()
-print(f"done. Found {len(exercises)} exercises.")
-print("Preparing individual TCX files", end="")
-for ex in exercises:
-    print(".", end="", flush=True)
-    xml = prepare_exercise_data(ex)
-    date_code = ex["start_time"][0:10]
-    write_to_file(f"exports/{ex['exercise_type']}_{date_code}_{ex['datauuid']}.tcx", xml)
-
-print("done")
+    schema_location = XML.QName(nsmap["xsi"], "schemaLocation")
+    root_attributes = {
+        schema_location: "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2 http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd",
+        "version": "1.1",
+    }
+    with open(filename, "wb") as f, XML.xmlfile(f, encoding="utf-8") as xf:
+        xf.write_declaration()
+        with xf.element("TrainingCenterDatabase", root_attributes, nsmap=nsmap):
+            with xf.element("Activities"):
+                with xf.element("Activity", activity.attrib):
+                    for child in activity:
+                        xf.write(child)
+                    # Make sure everything is on disk, before we bypass the XML writer.
+                    xf.flush()
+                    f.write(lap)
+                    has_track = False
+                    for tp in trackpoints:
+                        # Empty trackpoints should not be added.
+                        if tp is None:
+                            continue
+                        # We only add the track, if it contains at least one trackpoint.
+                        if not has_track:
+                            f.write(b"<Track>")
+                            has_track = True
+                        f.write(tp)
+                    if has_track:
+                        f.write(b"</Track>")
+                    f.write(b"</Lap>")
+
+
+def export_exercise(exercise):
+    """
+    Create the TCX file for one exercise. The exercises are independent of each other, so this
+    can run in a separate process for every exercise.
+    """
+    date_code = exercise["start_time"][0:10]
+    filename = f"exports/{exercise['exercise_type']}_{date_code}_{exercise['datauuid']}.tcx"
+    prepare_exercise_data(exercise, filename)
+
+
+# The exercises are exported by worker processes that import this file, so the script itself
+# must only run when it is started directly.
+if __name__ == "__main__":
+    # We will generate quite a bunch of files, so it is better to have them all in one
+    # subdir.
+    if not os.path.isdir("exports"):
+        os.makedirs("exports")
+
+    print("Fetching exercises...", end="")
+    exercises = fetch_exercise_list()
+    print(f"done. Found {len(exercises)} exercises.")
+    print("Preparing individual TCX files", end="")
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        for _ in executor.map(export_exercise, exercises, chunksize=4):
+            print(".", end="", flush=True)
+
+    print("done")
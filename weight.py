@@ -1,49 +1,93 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import csv
-import glob
-from typing import Dict, List
+import io
+import os
+from functools import lru_cache
+from operator import itemgetter
+from typing import List, Optional, Tuple
 
 
-def fetch_weight_data() -> List[Dict[str, float]]:
+# The columns of the exported weight data.
+COLUMNS = ("Date", "Weight", "Height", "BMI", "Fat")
+
+
+@lru_cache(maxsize=None)
+def list_files() -> Tuple[str, ...]:
+    """
+    List the names of all files in the current directory. The directory is only scanned once,
+    no matter how many different data files we are looking for.
+    """
+    with os.scandir() as entries:
+        return tuple(entry.name for entry in entries if entry.is_file())
+
+
+def find_file(prefix: str) -> Optional[str]:
+    """
+    Return the name of the first CSV file whose name starts with the given prefix,
+    e.g. com.samsung.health.weight. for com.samsung.health.weight.*.csv, or None.
+    """
+    for name in list_files():
+        if name.startswith(prefix) and name.endswith(".csv"):
+            return name
+    return None
+
+
+def fetch_weight_data() -> List[Tuple[str, float, float, float, float]]:
     """
     Fetch the weight data from the Samsung Health data export, which is
-    a CSV file. Return a list of dicts, one dict per dataset.
+    a CSV file. Return a list of tuples, one tuple per dataset, with the
+    values in the order of COLUMNS.
     """
 
-    weight_files = glob.glob("com.samsung.health.weight.*.csv")
-    if len(weight_files) == 0:
+    filename = find_file("com.samsung.health.weight.")
+    if filename is None:
         raise Exception("No weight data found.")
-    filename = weight_files[0]
 
     weight_data = []
     with open(filename, newline="") as f:
         next(f)
-        reader = csv.DictReader(f)
-        for row in reader:
-            weight = float(row["weight"])
-            height = float(row["height"])
+        reader = csv.reader(f)
+        header = next(reader)
+        columns = itemgetter(
+            header.index("start_time"),
+            header.index("weight"),
+            header.index("height"),
+            header.index("body_fat_mass"),
+        )
+        for start_time, weight, height, body_fat_mass in map(columns, reader):
+            weight = float(weight)
+            height = float(height)
             # If body fat is recorded, we will include it. However, Garmin Connect
             # will not show it.
             try:
-                fat_mass = float(row["body_fat_mass"])
+                fat_mass = float(body_fat_mass)
             except ValueError:
                 fat_mass = 0
 
             weight_data.append(
-                {
-                    "Date": row["start_time"][0:10],
-                    "Weight": weight,
-                    "Height": height,
-                    "BMI": round(weight / ((height / 100) ** 2), 2),
-                    "Fat": round(fat_mass / weight * 100, 1),
-                }
+                (
+                    start_time[0:10],
+                    weight,
+                    height,
+                    round(weight / ((height / 100) ** 2), 2),
+                    round(fat_mass / weight * 100, 1),
+                )
             )
 
     return weight_data
 
 
-def write_to_file(weight_data: List[Dict[str, float]]) -> None:
+def save_file(filename: str, content: str) -> None:
+    """
+    Write the prepared content of one CSV file.
+    """
+    with open(filename, "w", newline="") as dest:
+        dest.write(content)
+
+
+def write_to_file(weight_data: List[Tuple[str, float, float, float, float]]) -> None:
     """
     Write the data to a series of CSV files. We can only store a certain number of lines per file,
     because if the files become too large, Garmin Connect will fail importing them. Everything
@@ -51,29 +95,22 @@ def write_to_file(weight_data: List[Dict[str, float]]) -> None:
     """
     LINES_PER_FILE = 75
 
-    dest = None
-    lines_written = 0
-    columns = list(weight_data[0].keys())
-    for wd in weight_data:
-        if lines_written % LINES_PER_FILE == 0:
-            filename = f"weight-export-{lines_written // LINES_PER_FILE + 1}.csv"
-            if hasattr(dest, "close"):
-                dest.close()
-
-            dest = open(filename, "w", newline="")
-            dest.write("Body\n")
-            writer = csv.DictWriter(
-                dest, fieldnames=columns, lineterminator="\n", quoting=csv.QUOTE_ALL
-            )
-            writer.writeheader()
+    files = {}
+    for lines_written in range(0, len(weight_data), LINES_PER_FILE):
+        filename = f"weight-export-{lines_written // LINES_PER_FILE + 1}.csv"
+
+        # Assemble the whole file in memory first, so it can be written with a single call.
+        buffer = io.StringIO()
+        buffer.write("Body\n")
+        writer = csv.writer(buffer, lineterminator="\n", quoting=csv.QUOTE_ALL)
+        writer.writerow(COLUMNS)
+        writer.writerows(weight_data[lines_written : lines_written + LINES_PER_FILE])
 
-        writer.writerow(wd)
-        lines_written += 1
+        files[filename] = buffer.getvalue()
 
-    try:
-        dest.close()
-    except:
-        pass
+    # Writing the files is I/O bound, so we can write them all at the same time.
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        list(executor.map(save_file, files.keys(), files.values()))
 
 
 write_to_file(fetch_weight_data())